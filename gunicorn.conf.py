@@ -0,0 +1,22 @@
+# gunicorn main:app   (gunicorn tự đọc file này trong thư mục hiện tại)
+import multiprocessing, os, sys
+
+# UvicornWorker chọn uvloop + httptools khi có sẵn (đã kèm trong uvicorn[standard])
+worker_class = "uvicorn_worker.UvicornWorker"
+bind = os.getenv("BIND", "0.0.0.0:" + os.getenv("PORT", "8000"))
+
+# Chế độ Sheets: cache A:D, hàng đợi ghi và lock theo machine_key nằm trong RAM của từng process
+#   -> nhiều worker sẽ mất increment và tạo trùng dòng, nên luôn chỉ 1 worker (bỏ qua WEB_CONCURRENCY,
+#      vốn có thể do nền tảng hosting tự đặt).
+# Chế độ SQLite (LOCAL_DB_PATH): trạng thái dùng chung qua file DB -> 1 worker / core, cho phép WEB_CONCURRENCY.
+if os.getenv("LOCAL_DB_PATH", "").strip():
+    workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+else:
+    workers = 1
+    if int(os.getenv("WEB_CONCURRENCY", "1") or "1") > 1:
+        print("WARNING: WEB_CONCURRENCY=%s ignored: Google Sheets mode runs a single worker "
+              "(set LOCAL_DB_PATH to use more)" % os.environ["WEB_CONCURRENCY"], file=sys.stderr)
+
+keepalive = 30
+timeout = 60
+graceful_timeout = 30  # đủ cho lifespan flush hàng đợi ghi / snapshot cuối lên Sheets
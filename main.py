@@ -1,52 +1,152 @@
 from fastapi import FastAPI, HTTPException, Header, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import Optional
-import os, json
+from contextlib import asynccontextmanager
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import os, re, hmac, logging, sqlite3, threading, time, asyncio
 from datetime import datetime, timedelta, timezone
 
+import orjson
 import gspread
+from gspread.utils import ValueRenderOption, DateTimeOption
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 
 # NEW: JWT
 import jwt  # PyJWT
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+import anyio
+import anyio.to_thread
 
-app = FastAPI(title="License Server for Drive Uploader Pro", version="1.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # gspread là I/O blocking -> chạy trong threadpool; nới giới hạn mặc định (40) của anyio
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    global _WRITER_TASK, _FLUSH_LIMITER
+    if WRITE_FLUSH_MS > 0:
+        # flush chạy trên limiter riêng: các request đang chờ fut.result() giữ hết token của limiter mặc định
+        _FLUSH_LIMITER = anyio.CapacityLimiter(1)
+        _WRITER_TASK = asyncio.create_task(_writer_loop())
+    snapshot_task = None
+    if LOCAL_DB_PATH:
+        await run_in_threadpool(open_db)
+        snapshot_task = asyncio.create_task(_snapshot_loop())
+    try:
+        yield
+    finally:
+        # 2 khối riêng: snapshot cuối lỗi vẫn phải flush hàng đợi ghi
+        try:
+            if snapshot_task is not None:
+                snapshot_task.cancel()
+                await run_in_threadpool(snapshot_to_sheet)
+        finally:
+            if _WRITER_TASK is not None:
+                _WRITER_TASK.cancel()
+                _WRITER_TASK = None
+                await anyio.to_thread.run_sync(_flush_writes, limiter=_FLUSH_LIMITER)
+
+app = FastAPI(title="License Server for Drive Uploader Pro", version="1.1.0", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
 # ---------- Config ----------
 SHEET_ID = os.getenv("SHEET_ID", "").strip()
 SHEET_NAME = os.getenv("SHEET_NAME", "google drive").strip()
 LICENSE_API_KEY = os.getenv("LICENSE_API_KEY", "").strip()
 TZ_OFFSET_HOURS = int(os.getenv("TZ_OFFSET_HOURS", "7").strip())
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "200").strip())  # số lời gọi Sheets đồng thời
+WRITE_FLUSH_MS = int(os.getenv("WRITE_FLUSH_MS", "50").strip())  # gom các lần ghi dòng thành 1 batchUpdate (0 = ghi trực tiếp)
+WRITE_TIMEOUT_SEC = int(os.getenv("WRITE_TIMEOUT_SEC", "30").strip())  # thời gian tối đa 1 request chờ lần flush
+SHEETS_POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", "32").strip())  # số kết nối keep-alive tới Google
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "").strip()  # đặt -> SQLite là kho chính, Sheets chỉ nhận snapshot
+SNAPSHOT_SEC = int(os.getenv("SNAPSHOT_SEC", "30").strip())  # chu kỳ đẩy các dòng đã đổi từ SQLite lên Sheets
+INDEX_TTL_SEC = int(os.getenv("INDEX_TTL_SEC", "300").strip())  # tuổi tối đa của cache A:D trong RAM (sửa tay trên sheet có hiệu lực sau khoảng này)
 
 # NEW: JWT signing config
 PRIVATE_KEY_PEM  = os.getenv("PRIVATE_KEY_PEM", "").strip()
 PRIVATE_KEY_FILE = os.getenv("PRIVATE_KEY_FILE", "").strip()
 LICENSE_AUD      = os.getenv("LICENSE_AUD", "").strip()
 TOKEN_TTL_DAYS   = int(os.getenv("TOKEN_TTL_DAYS", "14").strip())  # offline token TTL
+TOKEN_CACHE_SEC  = int(os.getenv("TOKEN_CACHE_SEC", "60").strip())  # dùng lại token đã ký trong khoảng này (0 = tắt)
+TOKEN_CACHE_MAX  = 10_000
+
+# hằng số dựng sẵn, tránh tạo lại ở mỗi request
+_TZ = timezone(timedelta(hours=TZ_OFFSET_HOURS))
+_TRIAL_DELTA = timedelta(days=7)
+_TOKEN_DELTA = timedelta(days=TOKEN_TTL_DAYS)
+_AUD_CLAIM = {"aud": LICENSE_AUD} if LICENSE_AUD else {}
+_LICENSE_API_KEY_B = LICENSE_API_KEY.encode() if LICENSE_API_KEY else None
 
 # ---------- Helpers ----------
 def tz_now_gmt() -> datetime: return datetime.now(timezone.utc)
-def tz_now_gmt7() -> datetime: return datetime.now(timezone(timedelta(hours=TZ_OFFSET_HOURS)))
+def tz_now_gmt7() -> datetime: return datetime.now(_TZ)
 def fmt_iso(dt: datetime) -> str: return dt.isoformat(timespec="seconds")
 
-def get_gspread_client():
+_GC: Optional[gspread.Client] = None
+_WS: Optional[gspread.Worksheet] = None
+_LOCK = threading.Lock()
+
+def _authorize(creds: Credentials) -> gspread.Client:
+    # 1 session dùng chung, pool đủ lớn cho threadpool -> giữ TCP+TLS keep-alive giữa các request
+    session = AuthorizedSession(creds)
+    adapter = HTTPAdapter(pool_connections=SHEETS_POOL_SIZE, pool_maxsize=SHEETS_POOL_SIZE, max_retries=3)
+    session.mount("https://", adapter)
+    return gspread.Client(auth=creds, session=session)
+
+def _build_gspread_client() -> gspread.Client:
     sa_json = os.getenv("SA_JSON", "").strip()
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
     if sa_json:
-        data = json.loads(sa_json)
+        data = orjson.loads(sa_json)
         creds = Credentials.from_service_account_info(data, scopes=scopes)
-        return gspread.authorize(creds)
+        return _authorize(creds)
     gac_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "").strip()
     if not gac_path:
         raise RuntimeError("Service Account credentials not provided. Set SA_JSON or GOOGLE_APPLICATION_CREDENTIALS.")
     creds = Credentials.from_service_account_file(gac_path, scopes=scopes)
-    return gspread.authorize(creds)
+    return _authorize(creds)
+
+def get_gspread_client() -> gspread.Client:
+    # client giữ AuthorizedSession (keep-alive + token OAuth) -> tạo 1 lần / process
+    global _GC
+    if _GC is None:
+        with _LOCK:
+            if _GC is None:
+                _GC = _build_gspread_client()
+    return _GC
 
-def open_sheet():
+def open_sheet() -> gspread.Worksheet:
+    global _WS
     if not SHEET_ID:
         raise RuntimeError("SHEET_ID is not set")
-    sh = get_gspread_client().open_by_key(SHEET_ID)
-    return sh.worksheet(SHEET_NAME)
+    if _WS is None:
+        gc = get_gspread_client()
+        with _LOCK:
+            if _WS is None:
+                _WS = gc.open_by_key(SHEET_ID).worksheet(SHEET_NAME)
+    return _WS
+
+def invalidate_sheet():
+    global _GC, _WS
+    with _LOCK:
+        _GC = None
+        _WS = None
+    invalidate_index()
+
+def with_sheet(fn):
+    # chạy fn(ws); nếu Google trả 401 (token/phiên hỏng) -> dựng lại client và thử lại 1 lần
+    if LOCAL_DB_PATH:
+        return fn(None)  # kho chính là SQLite, không đụng tới Sheets trên đường request
+    try:
+        return fn(open_sheet())
+    except gspread.exceptions.APIError as e:
+        if getattr(e, "code", None) != 401:
+            raise
+        invalidate_sheet()
+        return fn(open_sheet())
 
 # ---------- Models ----------
 class LicenseRequest(BaseModel):
@@ -60,10 +160,10 @@ class LicenseResponse(BaseModel):
     created: bool
 
 # ---------- Security ----------
-def verify_api_key(x_api_key: Optional[str] = Header(default=None)):
-    if LICENSE_API_KEY:
-        if not x_api_key or x_api_key != LICENSE_API_KEY:
-            raise HTTPException(status_code=401, detail="Invalid or missing API key")
+async def verify_api_key(x_api_key: Optional[str] = Header(default=None)):
+    # so sánh constant-time; async để FastAPI không đẩy dependency này sang threadpool
+    if _LICENSE_API_KEY_B and not (x_api_key and hmac.compare_digest(x_api_key.encode(), _LICENSE_API_KEY_B)):
+        raise HTTPException(status_code=401, detail="Invalid or missing API key")
 
 # ---------- Google Sheets ops ----------
 COL_KEY = 1
@@ -71,20 +171,339 @@ COL_ACTIVATED = 2
 COL_EXPIRES = 3
 COL_RUNCOUNT = 4
 
+# hàng đợi ghi: (range, values, future); _writer_loop gom lại mỗi WRITE_FLUSH_MS thành 1 batch_update
+_WRITE_QUEUE: list[tuple[str, list, Future]] = []
+_WRITE_LOCK = threading.Lock()
+_WRITER_TASK: Optional[asyncio.Task] = None
+_FLUSH_LIMITER: Optional[anyio.CapacityLimiter] = None
+
 def _ensure_row(ws, row: int, machine_key: str, activated_at: str, expires_at: str, run_count: int):
-    ws.update(f"A{row}:D{row}", [[machine_key, activated_at, expires_at, str(run_count)]])
+    rng, values = f"A{row}:D{row}", [[machine_key, activated_at, expires_at, str(run_count)]]
+    if _WRITER_TASK is None:
+        ws.update(rng, values)
+    else:
+        fut: Future = Future()
+        with _WRITE_LOCK:
+            _WRITE_QUEUE.append((rng, values, fut))
+        try:
+            fut.result(timeout=WRITE_TIMEOUT_SEC)  # chờ lần flush kế tiếp; lỗi của batch được ném lại ở đây
+        except FutureTimeout:
+            # writer chết/kẹt: bỏ khỏi hàng đợi nếu chưa flush; không chắc dòng đã ghi hay chưa -> nạp lại cache
+            with _WRITE_LOCK:
+                if (rng, values, fut) in _WRITE_QUEUE:
+                    _WRITE_QUEUE.remove((rng, values, fut))
+            invalidate_index()
+            raise HTTPException(status_code=503, detail="Timed out waiting for Google Sheets write")
+    with _INDEX_LOCK:
+        _KEY_INDEX[machine_key] = (row, activated_at, expires_at, run_count)
+
+def _fill_dates(ws, row: int, machine_key: str, activated_at: str, expires_at: str, run_count: int) -> tuple[str, str, int]:
+    # ghi bù activated_at/expires_at còn trống; trả về (activated_at, expires_at, run_count) sau khi ghi
+    if LOCAL_DB_PATH:
+        return _db_fill_dates(machine_key, activated_at, expires_at)
+    _ensure_row(ws, row, machine_key, activated_at, expires_at, run_count)
+    return activated_at, expires_at, run_count
+
+def _increment_row(ws, row: int, machine_key: str, activated_at: str, expires_at: str, run_count: int) -> int:
+    # SQLite: tăng ngay trong DB (nguyên tử giữa các worker); Sheets: run_count vừa đọc lại từ dòng + 1 lần ghi
+    if LOCAL_DB_PATH:
+        return _db_increment(machine_key, activated_at, expires_at)
+    _ensure_row(ws, row, machine_key, activated_at, expires_at, run_count + 1)
+    return run_count + 1
+
+def _flush_writes():
+    with _WRITE_LOCK:
+        batch = _WRITE_QUEUE[:]
+        _WRITE_QUEUE.clear()
+    if not batch:
+        return
+    try:
+        open_sheet().batch_update([{"range": rng, "values": values} for rng, values, _ in batch],
+                                  value_input_option="RAW")
+    except Exception as e:
+        for _, _, fut in batch: fut.set_exception(e)
+    else:
+        for _, _, fut in batch: fut.set_result(None)
+
+async def _writer_loop():
+    while True:
+        await asyncio.sleep(WRITE_FLUSH_MS / 1000)
+        if _WRITE_QUEUE:
+            await anyio.to_thread.run_sync(_flush_writes, limiter=_FLUSH_LIMITER)
+
+def _parse_row(vals: list) -> tuple[str, str, str, int]:
+    vals = list(vals) + [""] * 4
+    key, activated_at, expires_at = (str(v or "").strip() for v in vals[:3])
+    run_val = vals[3]
+    if isinstance(run_val, (int, float)):
+        return key, activated_at, expires_at, int(run_val)
+    run_val = str(run_val).strip() if run_val is not None else ""
+    # isascii: isdigit() nhận cả chữ số Unicode kiểu "²" mà int() không parse được
+    run_count = int(run_val) if run_val.isascii() and run_val.isdigit() else 0
+    return key, activated_at, expires_at, run_count
+
+# đọc A:D: số giữ nguyên (UNFORMATTED), ngày nhập tay trả về chuỗi như hiển thị thay vì serial number
+_ROW_RENDER = {"value_render_option": ValueRenderOption.unformatted,
+               "date_time_render_option": DateTimeOption.formatted_string}
+
+# cache A:D trong RAM: machine_key -> (row, activated_at, expires_at, run_count); 1 dict để row và giá trị
+# luôn đi cùng nhau. Nạp lại bằng 1 lần đọc A:D khi quá INDEX_TTL_SEC; cập nhật tại chỗ mỗi lần ghi
+_KEY_INDEX: dict[str, tuple[int, str, str, int]] = {}
+_INDEX_AT = 0.0  # time.monotonic() lúc nạp; 0 = chưa nạp
+_INDEX_LOCK = threading.Lock()
+
+def _load_index(ws):
+    global _KEY_INDEX, _INDEX_AT
+    rows = ws.get("A:D", **_ROW_RENDER)
+    index: dict[str, tuple[int, str, str, int]] = {}
+    for idx, vals in enumerate(rows):
+        key, activated_at, expires_at, run_count = _parse_row(vals)
+        if key and key not in index:
+            index[key] = (idx + 1, activated_at, expires_at, run_count)
+    _KEY_INDEX = index
+    _INDEX_AT = time.monotonic()
+
+def _read_row(ws, row: int) -> tuple[str, str, str, int]:
+    vals = ws.get(f"A{row}:D{row}", **_ROW_RENDER)
+    return _parse_row(vals[0] if vals else [])
+
+def _ensure_index(ws):
+    if _INDEX_AT and time.monotonic() - _INDEX_AT < INDEX_TTL_SEC:
+        return
+    with _INDEX_LOCK:
+        if not _INDEX_AT or time.monotonic() - _INDEX_AT >= INDEX_TTL_SEC:
+            _load_index(ws)
+
+def invalidate_index():
+    global _INDEX_AT
+    with _INDEX_LOCK:
+        _INDEX_AT = 0.0
+
+_UPDATED_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+def _create_row(ws, machine_key: str, activated_at: str, expires_at: str, run_count: int) -> int:
+    # values.append (INSERT_ROWS): Google tự chọn dòng cuối bảng và trả về range đã ghi
+    # -> không cần quét cột A để tính số dòng, 2 request tạo key mới không ghi đè lên nhau
+    res = ws.append_row([machine_key, activated_at, expires_at, str(run_count)],
+                        value_input_option="RAW", insert_data_option="INSERT_ROWS", table_range="A:D")
+    row = int(_UPDATED_ROW_RE.search(res["updates"]["updatedRange"]).group(1))
+    _ensure_index(ws)
+    with _INDEX_LOCK:
+        _KEY_INDEX[machine_key] = (row, activated_at, expires_at, run_count)
+    return row
+
+# -> (row, (activated_at, expires_at, run_count), created); key mới được tạo với hạn dùng thử 7 ngày
+# fresh=True cho đường ghi: đọc lại dòng vì cache có thể cũ tới INDEX_TTL_SEC, tránh ghi đè giá trị admin vừa sửa
+def _get_or_create_row(ws, machine_key: str, fresh: bool = False) -> tuple[int, tuple[str, str, int], bool]:
+    if LOCAL_DB_PATH:
+        return _db_get_or_create(machine_key)
+    for _ in range(2):
+        _ensure_index(ws)
+        hit = _KEY_INDEX.get(machine_key)
+        if hit is None:
+            break
+        row, activated_at, expires_at, run_count = hit
+        if not fresh:
+            return row, (activated_at, expires_at, run_count), False
+        key, activated_at, expires_at, run_count = _read_row(ws, row)
+        if key == machine_key:
+            return row, (activated_at, expires_at, run_count), False
+        # sheet bị sắp xếp/chèn/xoá dòng -> số dòng trong cache đã lệch; nạp lại index rồi thử lần nữa
+        invalidate_index()
+    else:
+        raise HTTPException(status_code=503, detail="Sheet rows changed during lookup, please retry")
+    activated_at = fmt_iso(tz_now_gmt7())
+    expires_at = fmt_iso(tz_now_gmt7() + _TRIAL_DELTA)
+    row = _create_row(ws, machine_key, activated_at, expires_at, 0)
+    return row, (activated_at, expires_at, 0), True
+
+# ---------- Local store (SQLite, write-behind) ----------
+# Khi đặt LOCAL_DB_PATH: mọi đọc/ghi license đi vào SQLite (WAL, dùng chung được giữa các worker),
+# _snapshot_loop đẩy các dòng đã đổi lên Sheets mỗi SNAPSHOT_SEC bằng 1 batch_update + 1 append_rows.
+# Sheets lúc này chỉ là bảng xem cho người; sửa tay trên sheet không được đọc lại.
+_DB: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.Lock()
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS licenses (
+    machine_key  TEXT PRIMARY KEY,
+    activated_at TEXT NOT NULL,
+    expires_at   TEXT NOT NULL,
+    run_count    INTEGER NOT NULL DEFAULT 0,
+    sheet_row    INTEGER,                    -- NULL = chưa có dòng trên sheet
+    ver          INTEGER NOT NULL DEFAULT 1, -- tăng mỗi lần ghi
+    synced_ver   INTEGER NOT NULL DEFAULT 0  -- ver đã snapshot lên sheet
+);
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v REAL NOT NULL);
+"""
+
+def open_db() -> sqlite3.Connection:
+    global _DB
+    if _DB is not None:
+        return _DB
+    with _DB_LOCK:
+        if _DB is None:
+            conn = sqlite3.connect(LOCAL_DB_PATH, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")  # worker khác có thể đang seed từ sheet
+            conn.executescript(_DB_SCHEMA)
+            _seed_db(conn)
+            _DB = conn
+    return _DB
+
+def _seed_db(conn: sqlite3.Connection):
+    # lần đầu (DB trống): nạp toàn bộ A:D từ sheet; BEGIN IMMEDIATE để chỉ 1 worker làm việc này
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE k = 'seeded'").fetchone() is None:
+            rows = open_sheet().get("A:D", **_ROW_RENDER)
+            for idx, vals in enumerate(rows):
+                key, activated_at, expires_at, run_count = _parse_row(vals)
+                if key:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO licenses VALUES (?, ?, ?, ?, ?, 0, 0)",
+                        (key, activated_at, expires_at, run_count, idx + 1))
+            conn.execute("INSERT INTO meta VALUES ('seeded', ?)", (time.time(),))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _db_get_or_create(machine_key: str) -> tuple[int, tuple[str, str, int], bool]:
+    conn = open_db()
+    activated_at = fmt_iso(tz_now_gmt7())
+    expires_at = fmt_iso(tz_now_gmt7() + _TRIAL_DELTA)
+    with _DB_LOCK:
+        cur = conn.execute(
+            "INSERT INTO licenses (machine_key, activated_at, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(machine_key) DO NOTHING", (machine_key, activated_at, expires_at))
+        if cur.rowcount == 1:
+            return 0, (activated_at, expires_at, 0), True
+        sheet_row, activated_at, expires_at, run_count = conn.execute(
+            "SELECT sheet_row, activated_at, expires_at, run_count FROM licenses WHERE machine_key = ?",
+            (machine_key,)).fetchone()
+    return sheet_row or 0, (activated_at, expires_at, run_count), False
+
+def _db_fill_dates(machine_key: str, activated_at: str, expires_at: str) -> tuple[str, str, int]:
+    # chỉ điền ngày đang trống, không đụng run_count (worker khác có thể vừa increment);
+    # đọc + ghi trong 1 BEGIN IMMEDIATE, trả về giá trị thật của dòng sau khi ghi
+    conn = open_db()
+    with _DB_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE licenses SET "
+                "activated_at = CASE WHEN activated_at = '' THEN ? ELSE activated_at END, "
+                "expires_at = CASE WHEN expires_at = '' THEN ? ELSE expires_at END, "
+                "ver = ver + 1 "
+                "WHERE machine_key = ? AND (activated_at = '' OR expires_at = '')",
+                (activated_at, expires_at, machine_key))
+            row = conn.execute("SELECT activated_at, expires_at, run_count FROM licenses WHERE machine_key = ?",
+                               (machine_key,)).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return row
+
+def _db_increment(machine_key: str, activated_at: str, expires_at: str) -> int:
+    conn = open_db()
+    with _DB_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE licenses SET activated_at = ?, expires_at = ?, run_count = run_count + 1, ver = ver + 1 "
+                "WHERE machine_key = ?", (activated_at, expires_at, machine_key))
+            (run_count,) = conn.execute("SELECT run_count FROM licenses WHERE machine_key = ?",
+                                        (machine_key,)).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return run_count
 
-def _find_row_by_key(ws, machine_key: str) -> Optional[int]:
-    keys = ws.col_values(COL_KEY)
-    for idx, val in enumerate(keys):
-        if (val or "").strip() == machine_key:
-            return idx + 1
-    return None
+def _take_snapshot_lease(conn: sqlite3.Connection) -> Optional[float]:
+    # lease trong meta: nhiều worker cùng chạy _snapshot_loop nhưng mỗi lượt chỉ 1 worker ghi sheet
+    # -> trả về giá trị lease (hạn) để chỉ người giữ đúng lease đó mới được nhả
+    now = time.time()
+    lease = now + max(SNAPSHOT_SEC, 60)
+    with _DB_LOCK:
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('snapshot_lease', 0)")
+        cur = conn.execute("UPDATE meta SET v = ? WHERE k = 'snapshot_lease' AND v < ?", (lease, now))
+        return lease if cur.rowcount == 1 else None
+
+def snapshot_to_sheet():
+    lease = _take_snapshot_lease(_DB) if _DB is not None else None
+    if lease is None:
+        return
+    conn = _DB
+    try:
+        with _DB_LOCK:
+            dirty = conn.execute(
+                "SELECT machine_key, activated_at, expires_at, run_count, sheet_row, ver "
+                "FROM licenses WHERE ver != synced_ver ORDER BY rowid").fetchall()
+        if not dirty:
+            return
+        ws = open_sheet()
+        # sheet_row đã lưu có thể lệch (admin sắp xếp/chèn/xoá dòng) -> mỗi lượt đọc lại cột A 1 lần,
+        # chỉ ghi vào dòng mà cột A vẫn đúng là key đó; key không còn trên sheet thì append lại
+        sheet_rows: dict[str, int] = {}
+        for idx, val in enumerate(ws.col_values(COL_KEY)):
+            sheet_rows.setdefault(str(val or "").strip(), idx + 1)
+        synced: list[tuple[int, Optional[int], str]] = []  # (ver, sheet_row, machine_key)
+        updates = [(r, sheet_rows[r[0]]) for r in dirty if r[0] in sheet_rows]
+        if updates:
+            ws.batch_update([{"range": f"A{row}:D{row}", "values": [[r[0], r[1], r[2], str(r[3])]]}
+                             for r, row in updates], value_input_option="RAW")
+            synced += [(r[5], row, r[0]) for r, row in updates]
+        inserts = [r for r in dirty if r[0] not in sheet_rows]
+        if inserts:
+            res = ws.append_rows([[r[0], r[1], r[2], str(r[3])] for r in inserts],
+                                 value_input_option="RAW", insert_data_option="INSERT_ROWS", table_range="A:D")
+            first = int(_UPDATED_ROW_RE.search(res["updates"]["updatedRange"]).group(1))
+            synced += [(r[5], first + i, r[0]) for i, r in enumerate(inserts)]
+        with _DB_LOCK:
+            conn.executemany("UPDATE licenses SET synced_ver = ?, sheet_row = ? WHERE machine_key = ?", synced)
+    finally:
+        # lượt này có thể đã chạy quá hạn lease và worker khác đã lấy lease mới: không nhả lease của họ
+        with _DB_LOCK:
+            conn.execute("UPDATE meta SET v = 0 WHERE k = 'snapshot_lease' AND v = ?", (lease,))
+
+async def _snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_SEC)
+        try:
+            await run_in_threadpool(snapshot_to_sheet)
+        except Exception as e:
+            # các dòng vẫn dirty, lượt sau đẩy lại; log để lỗi kéo dài (quota, parse range...) không bị im lặng
+            logging.exception("snapshot SQLite -> Google Sheets failed")
+            if isinstance(e, gspread.exceptions.APIError) and getattr(e, "code", None) == 401:
+                invalidate_sheet()
 
 # ---------- Utilities ----------
+# dạng fmt_iso() ghi ra: YYYY-MM-DDTHH:MM:SS[Z|±HH:MM]
+_ISO_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:(Z)|([+-])(\d{2}):(\d{2}))?")
+_TZ_CACHE: dict[tuple[str, str, str], timezone] = {}
+
 def parse_iso_maybe(iso: str) -> Optional[datetime]:
     iso = (iso or "").strip()
     if not iso: return None
+    m = _ISO_RE.fullmatch(iso)
+    if m:
+        y, mo, d, h, mi, sec, _z, sign, oh, om = m.groups()
+        try:
+            tz = timezone.utc
+            if sign:
+                tz = _TZ_CACHE.get((sign, oh, om))
+                if tz is None:
+                    # timezone() ném ValueError với offset >= 24h (vd "+24:00" nhập tay)
+                    off = timedelta(hours=int(oh), minutes=int(om))
+                    tz = _TZ_CACHE[(sign, oh, om)] = timezone(-off if sign == "-" else off)
+            return datetime(int(y), int(mo), int(d), int(h), int(mi), int(sec), tzinfo=tz).astimezone(timezone.utc)
+        except ValueError:
+            return None
+    # định dạng khác (nhập tay trên sheet...) -> đường cũ
     try:
         dt = datetime.fromisoformat(iso)
         if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
@@ -96,123 +515,153 @@ def parse_iso_maybe(iso: str) -> Optional[datetime]:
         except Exception:
             return None
 
-def load_private_key() -> str:
-    if PRIVATE_KEY_PEM:
-        return PRIVATE_KEY_PEM
-    if PRIVATE_KEY_FILE and os.path.exists(PRIVATE_KEY_FILE):
-        return open(PRIVATE_KEY_FILE, "r", encoding="utf-8").read()
-    raise HTTPException(status_code=500, detail="PRIVATE_KEY_PEM/PRIVATE_KEY_FILE not set")
+_PRIVATE_KEY = None  # key object đã parse từ PEM, dùng lại cho mọi lần ký
+_TOKEN_ALG = "RS256"  # "EdDSA" nếu PEM là khoá Ed25519 (ký nhanh hơn RSA nhiều lần, chữ ký 64 byte)
+
+def load_private_key():
+    global _PRIVATE_KEY, _TOKEN_ALG
+    if _PRIVATE_KEY is None:
+        if PRIVATE_KEY_PEM:
+            pem = PRIVATE_KEY_PEM
+        elif PRIVATE_KEY_FILE and os.path.exists(PRIVATE_KEY_FILE):
+            with open(PRIVATE_KEY_FILE, "r", encoding="utf-8") as f:
+                pem = f.read()
+        else:
+            raise HTTPException(status_code=500, detail="PRIVATE_KEY_PEM/PRIVATE_KEY_FILE not set")
+        key = serialization.load_pem_private_key(pem.encode(), password=None)
+        _TOKEN_ALG = "EdDSA" if isinstance(key, Ed25519PrivateKey) else "RS256"
+        _PRIVATE_KEY = key
+    return _PRIVATE_KEY
+
+# cache token đã ký: (machine_key, rc, DB expires) -> (token, iat, exp); tránh ký RSA lại khi client poll
+_TOKEN_CACHE: dict[tuple[str, int, str], tuple[str, int, int]] = {}
+_TOKEN_LOCK = threading.Lock()
+
+def _cache_token(cache_key: tuple[str, int, str], token: str, iat: int, exp: int):
+    with _TOKEN_LOCK:
+        if len(_TOKEN_CACHE) >= TOKEN_CACHE_MAX:
+            for k in [k for k, v in _TOKEN_CACHE.items() if iat - v[1] >= TOKEN_CACHE_SEC]:
+                del _TOKEN_CACHE[k]
+            if len(_TOKEN_CACHE) >= TOKEN_CACHE_MAX:
+                _TOKEN_CACHE.clear()
+        _TOKEN_CACHE[cache_key] = (token, iat, exp)
 
 def build_offline_token(machine_key: str, run_count: int, db_expires_at_iso: str) -> str:
     now = tz_now_gmt()
+    now_ts = int(now.timestamp())
+    cache_key = (machine_key, run_count, db_expires_at_iso)
+    hit = _TOKEN_CACHE.get(cache_key)
+    if hit and now_ts - hit[1] < TOKEN_CACHE_SEC and now_ts < hit[2]:
+        return hit[0]
+
     # hạn offline token: min(DB expires, now + TOKEN_TTL_DAYS)
-    db_exp_dt = parse_iso_maybe(db_expires_at_iso) or (now + timedelta(days=TOKEN_TTL_DAYS))
-    ttl_exp_dt = now + timedelta(days=TOKEN_TTL_DAYS)
+    ttl_exp_dt = now + _TOKEN_DELTA
+    db_exp_dt = parse_iso_maybe(db_expires_at_iso) or ttl_exp_dt
     exp_dt = min(db_exp_dt, ttl_exp_dt)
 
     payload = {
         "machine_key": machine_key,
         "rc": run_count,
-        "iat": int(now.timestamp()),
-        "nbf": int(now.timestamp()),
-        "exp": int(exp_dt.timestamp())
+        "iat": now_ts,
+        "nbf": now_ts,
+        "exp": int(exp_dt.timestamp()),
+        **_AUD_CLAIM
     }
-    if LICENSE_AUD:
-        payload["aud"] = LICENSE_AUD
 
-    token = jwt.encode(payload, load_private_key(), algorithm="RS256")
+    key = load_private_key()
+    token = jwt.encode(payload, key, algorithm=_TOKEN_ALG)
     # PyJWT>=2.x: trả về str
+    if TOKEN_CACHE_SEC > 0:
+        _cache_token(cache_key, token, now_ts, payload["exp"])
     return token
 
+# ---------- Concurrency ----------
+# lock theo machine_key: tuần tự hoá read-modify-write của cùng 1 key trong process này
+_KEY_LOCKS: dict[str, list] = {}  # machine_key -> [asyncio.Lock, số request đang giữ/chờ]
+
+@asynccontextmanager
+async def key_lock(machine_key: str):
+    entry = _KEY_LOCKS.setdefault(machine_key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _KEY_LOCKS.pop(machine_key, None)
+
 # ---------- Routes ----------
+# /health bị probe liên tục -> dựng lại body tối đa 1 lần/giây
+_HEALTH_TS = 0
+_HEALTH_BODY = {"ok": True, "now": ""}
+
 @app.get("/health")
-def health():
-    return {"ok": True, "now": fmt_iso(tz_now_gmt7())}
+async def health():
+    global _HEALTH_TS, _HEALTH_BODY
+    t = int(time.time())
+    if t != _HEALTH_TS:
+        _HEALTH_BODY = {"ok": True, "now": fmt_iso(datetime.fromtimestamp(t, _TZ))}
+        _HEALTH_TS = t
+    return _HEALTH_BODY
 
+# response_model chỉ còn để sinh OpenAPI: route trả thẳng ORJSONResponse(dict), bỏ qua lượt validate của Pydantic
 @app.post("/license/get-or-create", response_model=LicenseResponse, dependencies=[Depends(verify_api_key)])
-def license_get_or_create(req: LicenseRequest):
-    ws = open_sheet()
-    row = _find_row_by_key(ws, req.machine_key)
-    created = False
-    if row is None:
-        keys = ws.col_values(COL_KEY)
-        row = len(keys) + 1
-        activated_at = fmt_iso(tz_now_gmt7())
-        expires_at = fmt_iso(tz_now_gmt7() + timedelta(days=7))
-        run_count = 0
-        _ensure_row(ws, row, req.machine_key, activated_at, expires_at, run_count)
-        created = True
-    else:
-        activated_at = ws.cell(row, COL_ACTIVATED).value or ""
-        expires_at = ws.cell(row, COL_EXPIRES).value or ""
-        run_val = ws.cell(row, COL_RUNCOUNT).value or "0"
-        try: run_count = int(str(run_val).strip() or "0")
-        except Exception: run_count = 0
+async def license_get_or_create(req: LicenseRequest):
+    async with key_lock(req.machine_key):
+        return ORJSONResponse(await run_in_threadpool(with_sheet, lambda ws: _license_get_or_create(ws, req)))
+
+def _license_get_or_create(ws, req: LicenseRequest) -> dict:
+    row, (activated_at, expires_at, run_count), created = _get_or_create_row(ws, req.machine_key)
+    if not created and (not activated_at or not expires_at):
+        # sắp ghi bù ngày còn trống: lấy giá trị mới nhất của dòng, không tin cache
+        row, (activated_at, expires_at, run_count), created = _get_or_create_row(ws, req.machine_key, fresh=True)
+    if not created:
         changed = False
         if not activated_at: activated_at = fmt_iso(tz_now_gmt7()); changed = True
-        if not expires_at:  expires_at  = fmt_iso(tz_now_gmt7() + timedelta(days=7)); changed = True
+        if not expires_at:  expires_at  = fmt_iso(tz_now_gmt7() + _TRIAL_DELTA); changed = True
         if changed:
-            _ensure_row(ws, row, req.machine_key, activated_at, expires_at, run_count)
-    return LicenseResponse(
-        machine_key=req.machine_key,
-        activated_at=activated_at,
-        expires_at=expires_at,
-        run_count=run_count,
-        created=created
-    )
+            activated_at, expires_at, run_count = _fill_dates(ws, row, req.machine_key, activated_at, expires_at, run_count)
+    return {
+        "machine_key": req.machine_key,
+        "activated_at": activated_at,
+        "expires_at": expires_at,
+        "run_count": run_count,
+        "created": created
+    }
 
 @app.post("/license/increment-run", response_model=LicenseResponse, dependencies=[Depends(verify_api_key)])
-def license_increment_run(req: LicenseRequest):
-    ws = open_sheet()
-    row = _find_row_by_key(ws, req.machine_key)
-    created = False
-    if row is None:
-        keys = ws.col_values(COL_KEY)
-        row = len(keys) + 1
-        activated_at = fmt_iso(tz_now_gmt7())
-        expires_at = fmt_iso(tz_now_gmt7() + timedelta(days=7))
-        run_count = 0
-        _ensure_row(ws, row, req.machine_key, activated_at, expires_at, run_count)
-        created = True
-    else:
-        activated_at = ws.cell(row, COL_ACTIVATED).value or fmt_iso(tz_now_gmt7())
-        expires_at  = ws.cell(row, COL_EXPIRES).value   or fmt_iso(tz_now_gmt7() + timedelta(days=7))
-        run_val = ws.cell(row, COL_RUNCOUNT).value or "0"
-        try: run_count = int(str(run_val).strip() or "0")
-        except Exception: run_count = 0
-
-    run_count += 1
-    _ensure_row(ws, row, req.machine_key, activated_at, expires_at, run_count)
-    return LicenseResponse(
-        machine_key=req.machine_key,
-        activated_at=activated_at,
-        expires_at=expires_at,
-        run_count=run_count,
-        created=created
-    )
-
-# NEW: cấp offline token RS256
+async def license_increment_run(req: LicenseRequest):
+    async with key_lock(req.machine_key):
+        return ORJSONResponse(await run_in_threadpool(with_sheet, lambda ws: _license_increment_run(ws, req)))
+
+def _license_increment_run(ws, req: LicenseRequest) -> dict:
+    row, (activated_at, expires_at, run_count), created = _get_or_create_row(ws, req.machine_key, fresh=True)
+    activated_at = activated_at or fmt_iso(tz_now_gmt7())
+    expires_at  = expires_at  or fmt_iso(tz_now_gmt7() + _TRIAL_DELTA)
+
+    run_count = _increment_row(ws, row, req.machine_key, activated_at, expires_at, run_count)
+    return {
+        "machine_key": req.machine_key,
+        "activated_at": activated_at,
+        "expires_at": expires_at,
+        "run_count": run_count,
+        "created": created
+    }
+
+# NEW: cấp offline token (RS256 hoặc EdDSA tuỳ khoá)
 class TokenResponse(BaseModel):
     token: str
 
 @app.post("/license/issue-token", response_model=TokenResponse, dependencies=[Depends(verify_api_key)])
-def license_issue_token(req: LicenseRequest):
-    ws = open_sheet()
-    row = _find_row_by_key(ws, req.machine_key)
-    if row is None:
-        # đảm bảo có dòng trong sheet
-        keys = ws.col_values(COL_KEY)
-        row = len(keys) + 1
-        activated_at = fmt_iso(tz_now_gmt7())
-        expires_at  = fmt_iso(tz_now_gmt7() + timedelta(days=7))
-        run_count = 0
-        _ensure_row(ws, row, req.machine_key, activated_at, expires_at, run_count)
-    else:
-        activated_at = ws.cell(row, COL_ACTIVATED).value or fmt_iso(tz_now_gmt7())
-        expires_at  = ws.cell(row, COL_EXPIRES).value   or fmt_iso(tz_now_gmt7() + timedelta(days=7))
-        run_val = ws.cell(row, COL_RUNCOUNT).value or "0"
-        try: run_count = int(str(run_val).strip() or "0")
-        except Exception: run_count = 0
+async def license_issue_token(req: LicenseRequest):
+    async with key_lock(req.machine_key):
+        return ORJSONResponse(await run_in_threadpool(with_sheet, lambda ws: _license_issue_token(ws, req)))
+
+def _license_issue_token(ws, req: LicenseRequest) -> dict:
+    # đảm bảo có dòng trong sheet
+    _, (_, expires_at, run_count), _ = _get_or_create_row(ws, req.machine_key)
+    expires_at = expires_at or fmt_iso(tz_now_gmt7() + _TRIAL_DELTA)
 
     tok = build_offline_token(req.machine_key, run_count, expires_at)
-    return TokenResponse(token=tok)
+    return {"token": tok}